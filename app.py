@@ -1,9 +1,69 @@
 import streamlit as st
 import pandas as pd
-from PyPDF2 import PdfMerger
+import numpy as np
+import pikepdf
 import os
 from pathlib import Path
 import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of label PDFs opened concurrently, and how many are queued at once
+PDF_OPEN_WORKERS = 8
+PDF_OPEN_BATCH_SIZE = 64
+
+# Merged PDFs larger than this are spooled to a temporary file
+PDF_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Parsed uploads kept in memory across reruns; the oldest are evicted first
+EXCEL_CACHE_MAX_ENTRIES = 4
+
+# "Item Summary" columns the merge needs, by lowercase name, and the names
+# they are renamed to for processing
+REQUIRED_COLUMNS = {"item id": "Item ID", "variation id": "Variation ID", "quantity": "quantity"}
+
+
+@st.cache_data(show_spinner=False, max_entries=EXCEL_CACHE_MAX_ENTRIES)
+def load_item_summary(raw_bytes):
+    """Read the required columns of the "Item Summary" sheet from an Excel file.
+    
+    Returns the workbook's sheet names and the sheet as a DataFrame, or None
+    in place of the DataFrame if the sheet does not exist.
+    """
+    excel_file = pd.ExcelFile(io.BytesIO(raw_bytes), engine="calamine")
+    if "Item Summary" not in excel_file.sheet_names:
+        return excel_file.sheet_names, None
+    
+    df = excel_file.parse(
+        "Item Summary",
+        usecols=lambda col: str(col).lower().strip() in REQUIRED_COLUMNS
+    )
+    return excel_file.sheet_names, df
+
+
+def open_label_pdf(pdf_path):
+    """Open a label PDF and drop any resources its pages never use.
+    
+    Pruning happens once per label, so unused fonts and images are left out
+    of every copy of that label in the merged PDF.
+    """
+    label_pdf = pikepdf.open(pdf_path)
+    label_pdf.remove_unreferenced_resources()
+    return label_pdf
+
+
+def append_label_copies(merged_pdf, source_pdf, quantity):
+    """Append every page of source_pdf to merged_pdf 'quantity' times.
+    
+    QPDF copies a foreign page's objects only once per source, so every
+    repeat shares the same content streams and resources and the output stays
+    close to the size of a single copy. Returns the number of pages added.
+    """
+    source_pages = list(source_pdf.pages)
+    for _ in range(quantity):
+        merged_pdf.pages.extend(source_pages)
+    return quantity * len(source_pages)
+
 
 st.set_page_config(page_title="MRP Label Merger", page_icon="📄", layout="wide")
 
@@ -15,45 +75,41 @@ uploaded_file = st.file_uploader("Choose an Excel file (.xlsx)", type=['xlsx'])
 
 if uploaded_file is not None:
     try:
-        # Read Excel file
-        excel_file = pd.ExcelFile(uploaded_file)
+        # Take the upload's bytes once; each reader below gets its own BytesIO
+        raw_bytes = uploaded_file.getvalue()
+        
+        # Read Excel file (cached, so reruns with the same upload skip parsing)
+        sheet_names, df = load_item_summary(raw_bytes)
         
         # Check if "Item Summary" sheet exists
-        if "Item Summary" not in excel_file.sheet_names:
+        if df is None:
             st.error("❌ Error: Sheet 'Item Summary' not found in the Excel file!")
-            st.info(f"Available sheets: {', '.join(excel_file.sheet_names)}")
+            st.info(f"Available sheets: {', '.join(sheet_names)}")
             st.stop()
         
-        # Read the Item Summary sheet
-        df = pd.read_excel(uploaded_file, sheet_name="Item Summary")
-        
-        # Create a mapping of lowercase column names to original column names
-        column_mapping = {col.lower().strip(): col for col in df.columns}
-        
-        # Check for required columns (case-insensitive)
-        required_columns_lower = ["item id", "variation id", "quantity"]
-        required_columns_display = ["Item ID", "Variation ID", "Quantity"]
-        
-        missing_columns = []
-        column_map = {}
+        # Normalise column names so they match case-insensitively; if a name
+        # appears more than once, keep the rightmost column
+        df.columns = [str(col).lower().strip() for col in df.columns]
+        df = df.loc[:, ~df.columns.duplicated(keep="last")]
         
-        for req_col_lower, req_col_display in zip(required_columns_lower, required_columns_display):
-            if req_col_lower in column_mapping:
-                column_map[req_col_display] = column_mapping[req_col_lower]
-            else:
-                missing_columns.append(req_col_display)
+        # Check for required columns
+        missing_columns = [
+            name for lower_name, name in REQUIRED_COLUMNS.items() if lower_name not in df.columns
+        ]
         
         if missing_columns:
             st.error(f"❌ Error: Missing required columns: {', '.join(missing_columns)}")
-            st.info(f"Available columns: {', '.join(df.columns.tolist())}")
+            all_columns = pd.read_excel(
+                io.BytesIO(raw_bytes),
+                sheet_name="Item Summary",
+                engine="calamine",
+                nrows=0
+            ).columns
+            st.info(f"Available columns: {', '.join(map(str, all_columns))}")
             st.stop()
         
         # Rename columns to standardized names for easier processing
-        df = df.rename(columns={
-            column_map["Item ID"]: "Item ID",
-            column_map["Variation ID"]: "Variation ID",
-            column_map["Quantity"]: "quantity"
-        })
+        df = df.rename(columns=REQUIRED_COLUMNS)
         
         # Remove empty rows (rows where all required columns are NaN)
         df = df.dropna(subset=["Item ID", "Variation ID", "quantity"], how='all')
@@ -61,10 +117,10 @@ if uploaded_file is not None:
         # Process button
         if st.button("🚀 Process and Merge PDFs", type="primary"):
             with st.spinner("Processing PDFs..."):
-                merger = PdfMerger()
+                merged_pdf = pikepdf.Pdf.new()
+                source_pdfs = []
                 total_pages = 0
                 processed_items = 0
-                missing_pdfs = []
                 errors = []
                 
                 # Path to mrp_label folder
@@ -74,65 +130,132 @@ if uploaded_file is not None:
                     st.error("❌ Error: 'mrp_label' folder not found in the current directory!")
                     st.stop()
                 
-                # Progress bar
-                progress_bar = st.progress(0)
-                status_text = st.empty()
+                # List the folder once instead of checking each PDF separately
+                available_pdfs = {
+                    entry.name for entry in os.scandir(label_folder) if entry.is_file()
+                }
                 
-                # Process each row
-                for idx, row in df.iterrows():
-                    try:
-                        item_id = row["Item ID"]
-                        variation_id = row["Variation ID"]
-                        quantity = row["quantity"]
-                        
-                        # Skip if quantity is 0, NaN, or negative
-                        if pd.isna(quantity) or quantity <= 0:
-                            continue
-                        
-                        # Convert to int
-                        quantity = int(quantity)
-                        
-                        # Determine which ID to use
-                        if pd.notna(variation_id) and variation_id != 0:
-                            use_id = int(variation_id)
-                        else:
-                            use_id = int(item_id)
-                        
-                        # PDF file path
-                        pdf_path = label_folder / f"{use_id}.pdf"
-                        
-                        # Check if PDF exists
-                        if not pdf_path.exists():
-                            missing_pdfs.append(use_id)
-                            continue
-                        
-                        # Merge the PDF 'quantity' times
-                        for _ in range(quantity):
-                            merger.append(str(pdf_path))
-                            total_pages += 1
+                # Convert the columns to numbers in one pass; bad cells become NaN
+                quantity_values = pd.to_numeric(df["quantity"], errors="coerce")
+                variation_ids = pd.to_numeric(df["Variation ID"], errors="coerce")
+                item_ids = pd.to_numeric(df["Item ID"], errors="coerce")
+                
+                for idx in df.index[df["quantity"].notna() & ~np.isfinite(quantity_values)]:
+                    errors.append(f"Row {idx + 2}: Invalid quantity '{df.at[idx, 'quantity']}'")
+                
+                # Use Variation ID when it is set and non-zero, otherwise Item ID
+                use_variation = variation_ids.notna() & (variation_ids != 0)
+                label_ids = pd.Series(
+                    np.where(use_variation, variation_ids, item_ids),
+                    index=df.index
+                )
+                
+                # Skip rows where quantity is 0, NaN, infinite, or negative
+                has_quantity = np.isfinite(quantity_values) & (quantity_values > 0)
+                
+                # An ID that is filled in but is not a number must not fall back to
+                # another label, or the wrong MRP label would be printed
+                bad_variation = (
+                    has_quantity & df["Variation ID"].notna() & ~np.isfinite(variation_ids)
+                )
+                bad_item = (
+                    has_quantity & ~bad_variation & ~use_variation
+                    & df["Item ID"].notna() & ~np.isfinite(item_ids)
+                )
+                for idx in df.index[bad_variation]:
+                    errors.append(f"Row {idx + 2}: Invalid Variation ID '{df.at[idx, 'Variation ID']}'")
+                for idx in df.index[bad_item]:
+                    errors.append(f"Row {idx + 2}: Invalid Item ID '{df.at[idx, 'Item ID']}'")
+                
+                # Rows without any ID cannot be matched to a PDF
+                has_valid_id = ~bad_variation & ~bad_item
+                for idx in df.index[has_quantity & has_valid_id & label_ids.isna()]:
+                    errors.append(f"Row {idx + 2}: No Item ID or Variation ID")
+                
+                keep = has_quantity & has_valid_id & label_ids.notna()
+                label_rows = pd.DataFrame({
+                    "use_id": label_ids[keep].astype("int64"),
+                    "quantity": quantity_values[keep].astype("int64")
+                })
+                
+                # Combine rows that point to the same PDF into a single quantity,
+                # keeping how many rows each PDF covers for the summary
+                label_totals = label_rows.groupby("use_id", sort=False)["quantity"].agg(["sum", "size"])
+                
+                # Report every ID without a PDF at once, then merge only the rest
+                has_pdf = (label_totals.index.astype(str) + ".pdf").isin(available_pdfs)
+                missing_pdfs = label_totals.index[~has_pdf].tolist()
+                label_totals = label_totals[has_pdf]
+                
+                # Plain lists iterate much faster than pandas objects
+                use_ids = label_totals.index.tolist()
+                counts = label_totals["sum"].tolist()
+                row_counts = label_totals["size"].tolist()
+                
+                # Progress bar, skipped when there is only one label to merge
+                show_progress = len(use_ids) > 1
+                if show_progress:
+                    progress_bar = st.progress(0)
+                    status_text = st.empty()
+                    progress_step = max(1, len(use_ids) // 100)
+                
+                # Process the unique PDFs in batches, opening each batch on a
+                # thread pool so disk reads overlap while pages are appended
+                with ThreadPoolExecutor(max_workers=PDF_OPEN_WORKERS) as executor:
+                    for batch_start in range(0, len(use_ids), PDF_OPEN_BATCH_SIZE):
+                        batch_end = batch_start + PDF_OPEN_BATCH_SIZE
+                        batch = list(zip(
+                            use_ids[batch_start:batch_end],
+                            counts[batch_start:batch_end],
+                            row_counts[batch_start:batch_end]
+                        ))
                         
-                        processed_items += 1
+                        # Start opening this batch's PDFs
+                        pending_pdfs = {
+                            use_id: executor.submit(open_label_pdf, label_folder / f"{use_id}.pdf")
+                            for use_id, _, _ in batch
+                        }
                         
-                    except Exception as e:
-                        errors.append(f"Row {idx + 2}: {str(e)}")
-                    
-                    # Update progress
-                    progress = (idx + 1) / len(df)
-                    progress_bar.progress(progress)
-                    status_text.text(f"Processing: {idx + 1}/{len(df)} rows")
+                        for i, (use_id, quantity, rows) in enumerate(batch, start=batch_start + 1):
+                            try:
+                                # Sources must stay open until the merged PDF is saved
+                                source_pdf = pending_pdfs[use_id].result()
+                                source_pdfs.append(source_pdf)
+                                
+                                total_pages += append_label_copies(merged_pdf, source_pdf, quantity)
+                                
+                                processed_items += rows
+                                
+                            except Exception as e:
+                                errors.append(f"ID {use_id}: {str(e)}")
+                            
+                            finally:
+                                # Update progress about 100 times in total, since
+                                # every update is a round trip to the browser
+                                if show_progress and (i % progress_step == 0 or i == len(use_ids)):
+                                    progress_bar.progress(i / len(use_ids))
+                                    status_text.text(f"Processing: {i}/{len(use_ids)} IDs")
                 
-                progress_bar.empty()
-                status_text.empty()
+                if show_progress:
+                    progress_bar.empty()
+                    status_text.empty()
                 
                 # Generate output filename
                 excel_filename = uploaded_file.name.replace('.xlsx', '')
                 output_filename = f"mrp_labels_{excel_filename}.pdf"
                 
-                # Save merged PDF to bytes
-                pdf_bytes = io.BytesIO()
-                merger.write(pdf_bytes)
-                merger.close()
-                pdf_bytes.seek(0)
+                # Save merged PDF to memory, spilling to disk if it gets large
+                pdf_buffer = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_SIZE, mode="w+b")
+                merged_pdf.save(
+                    pdf_buffer,
+                    linearize=False,
+                    object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                    compress_streams=True
+                )
+                merged_pdf.close()
+                for source_pdf in source_pdfs:
+                    source_pdf.close()
+                pdf_buffer.seek(0)
                 
                 # Display summary
                 st.success("✅ Processing Complete!")
@@ -160,13 +283,16 @@ if uploaded_file is not None:
                 if total_pages > 0:
                     st.download_button(
                         label="📥 Download Merged PDF",
-                        data=pdf_bytes,
+                        data=pdf_buffer.read(),
                         file_name=output_filename,
                         mime="application/pdf",
                         type="primary"
                     )
                 else:
                     st.warning("⚠️ No PDFs were merged. Please check your data and PDF files.")
+                
+                # Release the spooled file once Streamlit has its own copy
+                pdf_buffer.close()
     
     except Exception as e:
         st.error(f"❌ An error occurred: {str(e)}")